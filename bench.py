@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from PIL import Image
+import numpy as np
+
+from convert import BACKEND_MODULES, DEFAULT_PALETTE, METHODS, NN_BACKENDS, Quantizer, _importable, load_palette, palette_key
+
+KINDS = ('gradient', 'noise', 'photo', 'alpha')
+
+# 1ケースの繰り返しは合計でこの秒数を超えたら打ち切る (最低1回は測る)
+REPEAT_BUDGET = 5.0
+
+BAND = 512
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', type=int, nargs='+', default=[256, 1024, 2048], help='画像の一辺の画素数 (8192 まで)')
+    p.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS), help='合成する画像の種類')
+    p.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    p.add_argument('--backends', nargs='+', choices=['auto'] + list(NN_BACKENDS), default=list(NN_BACKENDS))
+    p.add_argument('--reduce-unique', choices=['off', 'on', 'both'], default='both')
+    p.add_argument('--reference', choices=list(NN_BACKENDS), default='brute', help='一致率の基準にするバックエンド (reduce_unique OFF)')
+    p.add_argument('--palette', '-p', default=DEFAULT_PALETTE, help='パレットファイルパス')
+    p.add_argument('--repeat', type=int, default=3, help='各ケースを測る回数 (最速の値を使う)')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--json', help='結果をJSONで保存するパス')
+    p.add_argument('--compare', help='以前に保存したJSONと速度・一致率を比べる')
+    return p.parse_args()
+
+
+def make_image(kind, size, seed):
+    # 同じ種類・サイズ・シードなら常に同じ画像になる。大きな画像でも
+    # float の一時配列が BAND 行分で済むように帯ごとに作る
+    rng = np.random.default_rng([seed, size, KINDS.index(kind)])
+    if kind == 'noise':
+        return rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+
+    ramp = (np.arange(size, dtype=np.uint32) * 255 // max(1, size - 1)).astype(np.uint8)
+    if kind == 'gradient':
+        arr = np.empty((size, size, 3), dtype=np.uint8)
+        arr[:, :, 0] = ramp[None, :]
+        arr[:, :, 1] = ramp[:, None]
+        for y in range(0, size, BAND):
+            arr[y:y + BAND, :, 2] = (ramp[None, :].astype(np.uint16) + ramp[y:y + BAND, None]) // 2
+        return arr
+
+    # photo: 粗い乱数格子をなめらかに拡大し、細かいノイズを足して写真のように色数の多い画像にする
+    grid = Image.fromarray(rng.integers(0, 256, (9, 9, 3), dtype=np.uint8), 'RGB')
+    arr = np.array(grid.resize((size, size), Image.BICUBIC))
+    for y in range(0, size, BAND):
+        band = arr[y:y + BAND]
+        band[:] = np.clip(band + rng.integers(-12, 13, band.shape, dtype=np.int16), 0, 255)
+    if kind == 'photo':
+        return arr
+
+    # alpha: 中央は不透明、外側に向かって半透明になり、四隅は完全に透明
+    alpha = np.empty((size, size), dtype=np.uint8)
+    c = np.linspace(-1.0, 1.0, size, dtype=np.float32)
+    for y in range(0, size, BAND):
+        r = np.sqrt(c[y:y + BAND, None] ** 2 + c[None, :] ** 2)
+        alpha[y:y + BAND] = np.clip((1.25 - r) * 255 * 1.5, 0, 255).astype(np.uint8)
+    return np.dstack([arr, alpha])
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB、macOS は byte 単位
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _run_case(case, palette, repeat, seed, ids_path):
+    # 1ケースごとに新しいプロセスで実行し、ピークRSSが他のケースの影響を受けないようにする
+    image = make_image(case['kind'], case['size'], seed)
+    q = Quantizer(palette, case['method'], case['backend'], case['reduce_unique'])
+    start = time.perf_counter()
+    try:
+        backend = q.prepare(case['size'] ** 2)
+    except ValueError as e:
+        return {'status': 'skipped', 'reason': str(e)}
+    result = {
+        'status': 'ok',
+        'resolved_backend': backend,
+        'setup_seconds': time.perf_counter() - start,
+        'rss_setup_mb': peak_rss_mb(),
+    }
+
+    times = []
+    while len(times) < repeat and sum(times) < REPEAT_BUDGET:
+        start = time.perf_counter()
+        ids = q.quantize(image)
+        times.append(time.perf_counter() - start)
+    np.save(ids_path, ids)
+
+    megapixels = case['size'] ** 2 / 1e6
+    result.update({
+        'runs': len(times),
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'mp_per_s': megapixels / min(times),
+        'rss_peak_mb': peak_rss_mb(),
+    })
+    return result
+
+
+def run_isolated(case, palette, args, ids_path):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as ex:
+        try:
+            return ex.submit(_run_case, case, palette, args.repeat, args.seed, ids_path).result()
+        except BrokenProcessPool:
+            return {'status': 'error', 'reason': 'プロセスが異常終了しました (メモリ不足の可能性があります)'}
+        except Exception as e:
+            return {'status': 'error', 'reason': f'{type(e).__name__}: {e}'}
+
+
+def skip_reason(case):
+    # KD木のバックエンドは外部ライブラリがあるときだけ測る
+    module = BACKEND_MODULES.get(case['backend'])
+    if module and not _importable(module):
+        return f'{module} がインストールされていません'
+    if case['backend'] == 'lut' and case['reduce_unique']:
+        return 'lut は reduce_unique を使わないため OFF と同じです'
+    return None
+
+
+def agreement(ref_path, ids_path):
+    if not os.path.exists(ref_path) or not os.path.exists(ids_path):
+        return None
+    ref = np.load(ref_path, mmap_mode='r')
+    ids = np.load(ids_path, mmap_mode='r')
+    return float(np.count_nonzero(ref == ids)) / ref.size
+
+
+def build_cases(args):
+    flags = {'off': [False], 'on': [True], 'both': [False, True]}[args.reduce_unique]
+    cases = []
+    for size in args.sizes:
+        for kind in args.kinds:
+            for method in args.methods:
+                # 一致率を求めるため、基準のケースを先に実行する
+                cases.append({'kind': kind, 'size': size, 'method': method,
+                              'backend': args.reference, 'reduce_unique': False, 'reference': True})
+                for backend in args.backends:
+                    for reduce_unique in flags:
+                        if backend == args.reference and not reduce_unique:
+                            continue
+                        cases.append({'kind': kind, 'size': size, 'method': method,
+                                      'backend': backend, 'reduce_unique': reduce_unique, 'reference': False})
+    return cases
+
+
+def case_key(r):
+    return (r['kind'], r['size'], r['method'], r['backend'], r['reduce_unique'])
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def print_result(r):
+    name = f"{r['kind']:8} {r['size']:>5}² {r['method']:8} {r['backend']:7} ru={'on ' if r['reduce_unique'] else 'off'}"
+    if r['status'] != 'ok':
+        print(f"{name}  {r['status']}: {r['reason']}")
+        return
+    rss = f"{r['rss_peak_mb']:.0f}MB" if r['rss_peak_mb'] is not None else '-'
+    agree = f"{r['agreement']:.4%}" if r.get('agreement') is not None else '-'
+    print(f"{name}  {r['mp_per_s']:9.2f} MP/s  準備 {r['setup_seconds']:6.2f}秒  RSS {rss:>7}  一致率 {agree}")
+
+
+def compare(results, path):
+    with open(path, encoding='utf-8') as f:
+        old = {case_key(r): r for r in json.load(f)['results'] if r['status'] == 'ok'}
+    print(f'\n{path} との比較 (速度比 = 今回 / 前回)')
+    for r in results:
+        prev = old.get(case_key(r))
+        if r['status'] != 'ok' or prev is None:
+            continue
+        ratio = r['mp_per_s'] / prev['mp_per_s']
+        note = ''
+        if r.get('agreement') is not None and prev.get('agreement') is not None and r['agreement'] < prev['agreement']:
+            note = f"  一致率低下 {prev['agreement']:.4%} -> {r['agreement']:.4%}"
+        if ratio < 0.9 or ratio > 1.1 or note:
+            print(f"  {' '.join(str(k) for k in case_key(r))}: {ratio:.2f}x{note}")
+
+
+def main():
+    print("PlaceBot(bench.py) by @raizouxyz")
+    print("Repository: https://github.com/raizouxyz/placebot\n")
+
+    args = parse_args()
+    palette = load_palette(args.palette)
+    cases = build_cases(args)
+    print(f'パレット: {palette.shape[0]} 色, {len(cases)} ケース\n')
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in cases:
+            ids_path = os.path.join(tmp, '{kind}_{size}_{method}_{backend}_{reduce_unique}.npy'.format(**case))
+            ref_path = os.path.join(tmp, f"{case['kind']}_{case['size']}_{case['method']}_{args.reference}_False.npy")
+            r = dict(case, megapixels=case['size'] ** 2 / 1e6)
+            reason = skip_reason(case)
+            if reason:
+                r.update(status='skipped', reason=reason)
+            else:
+                r.update(run_isolated(case, palette, args, ids_path))
+            if r['status'] == 'ok':
+                r['agreement'] = agreement(ref_path, ids_path)
+                if not case['reference']:
+                    os.remove(ids_path)
+            print_result(r)
+            results.append(r)
+
+    if args.json:
+        report = {
+            'revision': git_revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'palette': palette_key(palette, ''),
+            'seed': args.seed,
+            'reference': args.reference,
+            'results': results,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'\nJSONを保存しました: {args.json}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,190 @@
 import argparse
+import contextlib
+import glob
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import struct
 import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from multiprocessing import resource_tracker, shared_memory
 from PIL import Image
 import numpy as np
 
-_have_sklearn = False
-_have_scipy = False
-_have_skimage = False
-_have_colormath = False
-try:
-    from sklearn.neighbors import KDTree
-    _have_sklearn = True
-except Exception:
-    _have_sklearn = False
-
-try:
-    from scipy.spatial import cKDTree as ScipyKDTree
-    _have_scipy = True
-except Exception:
-    _have_scipy = False
-
-try:
-    from skimage.color import rgb2lab
-    _have_skimage = True
-except Exception:
-    _have_skimage = False
-
-try:
-    from colormath.color_objects import sRGBColor, LabColor
-    from colormath.color_conversions import convert_color
-    from colormath.color_diff import delta_e_cie2000
-    _have_colormath = True
-except Exception:
-    _have_colormath = False
+DEFAULT_PALETTE = './data/palette.txt'
+LUT_CACHE_DIR = './data/cache'
+METHODS = ('rgb', 'weighted', 'lab')
+
+# 色番号の出力では 0 を消しゴム(透明)に予約し、パレットの i 番目の色を i+1 とする
+TRANSPARENT_INDEX = 0
+
+# 出力形式ごとのファイル名の接尾辞と拡張子 (None は入力と同じ拡張子)
+OUTPUT_SUFFIXES = {
+    'rgb': ('_converted', None),
+    'indexed': ('_indexed', '.png'),
+    'npy': ('_indexed', '.npy'),
+}
+
+# 変換表がまだないとき、auto でこの画素数以上を一度に変換するなら変換表を作って使う。
+# 表を作るのは 2^24 色を探索するのと同じ手間なので、その2倍を超えて初めて元が取れる
+LUT_AUTO_PIXELS = 1 << 25
+
+# (除数 (2の累乗), [(dy, dx, 重み), ...])
+DIFFUSION_KERNELS = {
+    'floyd-steinberg': (16, [(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)]),
+    'atkinson': (8, [(0, 1, 1), (0, 2, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1), (2, 0, 1)]),
+    'sierra': (32, [(0, 1, 5), (0, 2, 3), (1, -2, 2), (1, -1, 4), (1, 0, 5), (1, 1, 4), (1, 2, 2),
+                    (2, -1, 2), (2, 0, 3), (2, 1, 2)]),
+}
+
+# 誤差拡散では画素値と誤差を 1/2^DIFFUSION_SHIFT 単位の整数で持つ
+DIFFUSION_SHIFT = 8
+
+# 縮小するとき、一度に float に変換する元画像の画素数
+RESIZE_BAND_PIXELS = 1 << 18
+
+# --profile でこの大きさ以上の配列を「大きな一時配列」として数える
+LARGE_TEMP_BYTES = 1 << 20
+
+
+# 段階ごとの経過時間と、tracemalloc で追跡できる確保量 (NumPy と Python のオブジェクト。
+# PIL 内部の画像バッファは含まない) のピークを集計する。段階は入れ子にでき、
+# 'quantize/query' のように親の名前を付けて別々に数える。1スレッドからだけ使う
+class StageProfiler:
+    def __init__(self):
+        self.stages = {}
+        self.stack = []
+        self.peak = 0
+        self.start = time.perf_counter()
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][2] = max(self.stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        path = f'{self.stack[-1][0]}/{name}' if self.stack else name
+        stat = self.stages.setdefault(path, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0,
+                                             'temps': 0, 'temp_bytes': 0, 'max_temp_bytes': 0})
+        frame = [path, current, current]
+        self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            peak = max(frame[2], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            if self.stack:
+                self.stack[-1][2] = max(self.stack[-1][2], peak)
+            self.peak = max(self.peak, peak)
+            stat['calls'] += 1
+            stat['seconds'] += elapsed
+            stat['peak_bytes'] = max(stat['peak_bytes'], peak - frame[1])
+
+    def note(self, arr):
+        if not self.stack or arr is None or arr.nbytes < LARGE_TEMP_BYTES:
+            return
+        stat = self.stages[self.stack[-1][0]]
+        stat['temps'] += 1
+        stat['temp_bytes'] += arr.nbytes
+        stat['max_temp_bytes'] = max(stat['max_temp_bytes'], arr.nbytes)
+
+    def to_dict(self):
+        return {
+            'total_seconds': time.perf_counter() - self.start,
+            'peak_bytes': max(self.peak, tracemalloc.get_traced_memory()[1]),
+            'large_temp_bytes': LARGE_TEMP_BYTES,
+            'stages': [dict(name=path, **stat) for path, stat in self.stages.items()],
+        }
+
+    def print_table(self):
+        report = self.to_dict()
+        total = report['total_seconds']
+        mb = 1 / 2**20
+        print(f"\n{'段階':<32}{'回数':>8}{'時間(秒)':>10}{'割合':>8}{'ピーク(MB)':>12}{'一時配列':>8}{'合計(MB)':>10}")
+        for s in report['stages']:
+            depth = s['name'].count('/')
+            name = '  ' * depth + s['name'].rsplit('/', 1)[-1]
+            print(f"{name:<32}{s['calls']:>8}{s['seconds']:>10.3f}{s['seconds'] / total:>8.1%}"
+                  f"{s['peak_bytes'] * mb:>12.1f}{s['temps']:>8}{s['temp_bytes'] * mb:>10.1f}")
+        print(f"{'合計':<32}{'':>8}{total:>10.3f}{'':>8}{report['peak_bytes'] * mb:>12.1f}")
+
+# --profile のときだけ main で設定する
+_profiler = None
+
+
+def profile_stage(name):
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+def profile_array(arr):
+    if _profiler is not None:
+        _profiler.note(arr)
+    return arr
 
 
 def parse_args():
     p = argparse.ArgumentParser()
-    p.add_argument('--input', '-i', required=True, help='入力画像ファイルパス')
-    p.add_argument('--method', '-m', choices=['rgb', 'weighted', 'lab'], default='rgb')
+    p.add_argument('--input', '-i', required=True, help='入力画像ファイルパス (ディレクトリやワイルドカードを指定すると一括変換)')
+    p.add_argument('--palette', '-p', default=DEFAULT_PALETTE, help='パレットファイルパス')
+    p.add_argument('--method', '-m', choices=METHODS, default='rgb',
+                   help='色の距離 (lab は CIEDE2000。総当たりでは rgb の数十倍遅いが、一度 --nn-backend lut で'
+                        '変換表を作れば以降は auto でも表を使い、rgb と同程度の速さになる)')
     p.add_argument('--reduce_unique', action='store_true')
-    return p.parse_args()
+    p.add_argument('--nn-backend', choices=['auto'] + list(NN_BACKENDS), default='auto',
+                   help='最近傍パレット色の探索方法 (auto は色数と画素数から選ぶ)')
+    p.add_argument('--dither', '-d', choices=['none', 'ordered'] + list(DIFFUSION_KERNELS), default='none', help='ディザリング (ordered は組織的ディザ、それ以外は誤差拡散)')
+    p.add_argument('--bayer-size', type=int, choices=[2, 4, 8, 16], default=8, help='組織的ディザのBayer行列サイズ')
+    p.add_argument('--threshold-map', help='Bayer行列の代わりに使う閾値テクスチャ画像 (ブルーノイズ等)')
+    p.add_argument('--dither-strength', type=float, default=32.0, help='組織的ディザの振れ幅 (RGB値)')
+    p.add_argument('--alpha-threshold', type=int, default=1,
+                   help='アルファがこの値未満の画素を透明 (消しゴム, 色番号0) として扱い、色の探索を省く (1〜256。'
+                        'アルファ0の画素は常に透明)')
+    p.add_argument('--background', help='半透明の画素をこの色 (#rrggbb) と合成して不透明にしてから変換する')
+    p.add_argument('--strip-height', type=int, default=0, help='指定した行数ずつ読み込み・変換・PNG書き出しを行う (0で無効)')
+    p.add_argument('--width', type=int, help='この幅に縮小してから変換する (--width だけなら縦横比を保つ。元より大きい値は元の幅になる)')
+    p.add_argument('--height', type=int, help='この高さに縮小してから変換する (--height だけなら縦横比を保つ。元より大きい値は元の高さになる)')
+    p.add_argument('--scale', type=float, help='この倍率で縮小してから変換する (1以下。例: 0.25)')
+    p.add_argument('--workers', type=int, default=1, help='並列に変換するプロセス数')
+    p.add_argument('--force', action='store_true', help='一括変換で出力が最新 (入力より新しく、設定も前回と同じ) でも変換し直す')
+    p.add_argument('--incremental', action='store_true',
+                   help='タイルごとに前回の変換結果をキャッシュし、変わったタイルだけ変換し直す (静止画のみ)')
+    p.add_argument('--tile-size', type=int, default=256, help='--incremental で比べるタイルの大きさ')
+    p.add_argument('--format', '-f', nargs='+', choices=list(OUTPUT_SUFFIXES), default=['rgb'],
+                   help='出力形式 (rgb: パレット色の画像, indexed: パレットモードPNG, npy: 色番号の配列)')
+    p.add_argument('--profile', action='store_true', help='段階ごとの時間とメモリのピークを表示する (tracemalloc を使うため少し遅くなる)')
+    p.add_argument('--profile-json', help='--profile の結果をJSONで保存するパス (指定すると --profile も有効になる)')
+    args = p.parse_args()
+    if args.scale is not None and (args.width or args.height):
+        p.error('--scale と --width/--height は同時に指定できません。')
+    if not 1 <= args.alpha_threshold <= 256:
+        p.error('--alpha-threshold には 1〜256 を指定してください。')
+    if args.tile_size <= 0:
+        p.error('--tile-size には正の値を指定してください。')
+    module = BACKEND_MODULES.get(args.nn_backend)
+    if module and not _importable(module):
+        p.error(f'--nn-backend {args.nn_backend} には {module} のインストールが必要です。')
+    if args.nn_backend == 'int' and args.method not in _INT_WEIGHTS or \
+            args.nn_backend in BACKEND_MODULES and args.method == 'lab':
+        p.error(f'--nn-backend {args.nn_backend} は -m {args.method} に対応していません。')
+    if args.strip_height < 0:
+        p.error('--strip-height には0以上の値を指定してください。')
+    if args.workers < 1:
+        p.error('--workers には1以上の値を指定してください。')
+    if any(v is not None and v <= 0 for v in (args.width, args.height, args.scale)):
+        p.error('--width/--height/--scale には正の値を指定してください。')
+    if args.scale is not None and args.scale > 1:
+        p.error('--scale は縮小だけに使えるため、1以下の値を指定してください。')
+    return args
 
 
 def load_palette(path):
@@ -63,6 +208,14 @@ def load_palette(path):
         raise ValueError('パレットが空です。')
     return np.array(colors, dtype=np.uint8)
 
+def parse_color(s):
+    s = s.strip().lstrip('#')
+    if len(s) == 3:
+        s = ''.join([c*2 for c in s])
+    if len(s) != 6:
+        raise ValueError(f'色がHEX 6桁ではありません: {s!r}')
+    return np.array([int(s[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.uint8)
+
 
 def rgb_to_array(img):
     if img.mode not in ('RGB', 'RGBA'):
@@ -73,168 +226,1249 @@ def rgb_to_array(img):
     return arr, None
 
 
-def build_nn_index(palette_arr, metric='euclidean'):
-    palette_float = palette_arr.astype(float)
-    if _have_sklearn:
-        tree = KDTree(palette_float, leaf_size=40, metric=metric)
-        def query(points):
-            dist, idx = tree.query(points, return_distance=True)
-            return idx if idx.ndim == 1 else idx[:,0]
-        return query
-    if _have_scipy:
-        tree = ScipyKDTree(palette_float)
-        def query(points):
-            _, idx = tree.query(points)
-            return idx
-        return query
-    def query(points):
-        M = points.shape[0]
-        N = palette_float.shape[0]
-        idxs = np.empty(M, dtype=int)
-        chunk = 100000
-        for start in range(0, M, chunk):
-            end = min(M, start+chunk)
-            pts = points[start:end][:, None, :]  # (C,1,3)
-            dif = pts - palette_float[None, :, :]  # (C,N,3)
-            d2 = np.sum(dif*dif, axis=2)  # (C,N)
-            idxs[start:end] = np.argmin(d2, axis=1)
-        return idxs
+_SRGB_TO_LINEAR = np.where(
+    np.arange(256) <= 10,
+    np.arange(256) / 255.0 / 12.92,
+    ((np.arange(256) / 255.0 + 0.055) / 1.055) ** 2.4,
+).astype(np.float32)
+
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=np.float32)
+
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+
+def srgb_to_lab(arr):
+    if arr.dtype == np.uint8:
+        lin = _SRGB_TO_LINEAR[arr]
+    else:
+        f = np.clip(arr.astype(np.float32) / 255.0, 0.0, 1.0)
+        lin = np.where(f <= 0.04045, f / 12.92, ((f + 0.055) / 1.055) ** 2.4).astype(np.float32)
+    xyz = lin @ (_RGB_TO_XYZ.T / _D65_WHITE[None, :])
+    eps = np.float32((6 / 29) ** 3)
+    f = np.where(xyz > eps, np.cbrt(xyz), xyz * np.float32(1 / (3 * (6 / 29) ** 2)) + np.float32(4 / 29))
+    lab = np.empty_like(f)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+_25_POW_7 = np.float32(25.0 ** 7)
+_T_COS = np.cos(np.radians([30.0, 6.0, 63.0, 275.0])).astype(np.float32)
+_T_SIN = np.sin(np.radians([30.0, 6.0, 63.0, 275.0])).astype(np.float32)
+
+
+def _chroma(a, b):
+    return np.sqrt(a * a + b * b)
+
+def ciede2000(lab1, lab2):
+    # (N, M) の向きで計算すると内側の次元が長くなり速い
+    L1, a1, b1 = lab1[None, :, 0], lab1[None, :, 1], lab1[None, :, 2]
+    L2, a2, b2 = lab2[:, 0:1], lab2[:, 1:2], lab2[:, 2:3]
+    Cbar7 = ((_chroma(a1, b1) + _chroma(a2, b2)) * 0.5) ** 7
+    G1 = 1.5 - 0.5 * np.sqrt(Cbar7 / (Cbar7 + _25_POW_7))
+    a1p = a1 * G1
+    a2p = a2 * G1
+    C1p = _chroma(a1p, b1)
+    C2p = _chroma(a2p, b2)
+    CpProd = C1p * C2p
+
+    # ΔH' = 2√(C1'C2')·sin(Δh'/2) を三角関数なしで求める
+    dot = a1p * a2p + b1 * b2
+    cross = a1p * b2 - b1 * a2p
+    dHp = np.copysign(np.sqrt(np.maximum(2.0 * (CpProd - dot), 0.0)), cross)
+
+    # 平均色相 h̄' は二つの色相の単位ベクトルの和の向き
+    # (片方の彩度が0ならもう片方の色相、両方0なら Sh と Rt に効かない)
+    inv1 = 1.0 / np.maximum(C1p, 1e-12)
+    inv2 = 1.0 / np.maximum(C2p, 1e-12)
+    sx = a1p * inv1 + a2p * inv2
+    sy = b1 * inv1 + b2 * inv2
+    inv_norm = 1.0 / np.maximum(_chroma(sx, sy), 1e-12)
+    c1 = sx * inv_norm
+    s1 = sy * inv_norm
+    c2 = c1 * c1 - s1 * s1
+    s2 = 2.0 * c1 * s1
+    c3 = c1 * (4.0 * c1 * c1 - 3.0)
+    s3 = s1 * (3.0 - 4.0 * s1 * s1)
+    c4 = c2 * c2 - s2 * s2
+    s4 = 2.0 * c2 * s2
+    T = (1.0 - 0.17 * (c1 * _T_COS[0] + s1 * _T_SIN[0]) + 0.24 * c2
+         + 0.32 * (c3 * _T_COS[1] - s3 * _T_SIN[1]) - 0.20 * (c4 * _T_COS[2] + s4 * _T_SIN[2]))
+
+    # h̄' - 275° を (-180°, 180°] で求める。h̄' ∈ [0°, 360°) との差は exp(-(180/25)^2) 未満
+    hrel = np.arctan2(s1 * _T_COS[3] - c1 * _T_SIN[3], c1 * _T_COS[3] + s1 * _T_SIN[3])
+    hrel = np.where(hrel < np.float32(np.radians(85.0)), hrel, np.float32(np.pi))
+    dtheta = np.float32(np.pi / 6) * np.exp(np.maximum(hrel * hrel * np.float32(-(180 / np.pi / 25.0) ** 2), -40.0))
+
+    Lbarp = (L1 + L2) * 0.5
+    Cbarp = (C1p + C2p) * 0.5
+    Cbarp7 = Cbarp ** 7
+    Rt = -2.0 * np.sqrt(Cbarp7 / (Cbarp7 + _25_POW_7)) * np.sin(2.0 * dtheta)
+    Lm50 = (Lbarp - 50.0) ** 2
+    Sl = 1.0 + 0.015 * Lm50 / np.sqrt(20.0 + Lm50)
+    Sc = 1.0 + 0.045 * Cbarp
+    Sh = 1.0 + 0.015 * Cbarp * T
+
+    tl = (L2 - L1) / Sl
+    tc = (C2p - C1p) / Sc
+    th = dHp / Sh
+    return np.sqrt(np.maximum(tl * tl + tc * tc + th * th + Rt * tc * th, 0.0)).T
+
+def nearest_ciede2000(query_points, palette_lab):
+    M = query_points.shape[0]
+    idxs = np.empty(M, dtype=int)
+    pal = palette_lab.astype(np.float32)
+    chunk = 8192
+    for s in range(0, M, chunk):
+        e = min(M, s+chunk)
+        with profile_stage('query'):
+            d = ciede2000(query_points[s:e].astype(np.float32), pal)
+            idxs[s:e] = np.argmin(d.T, axis=0)
+    return idxs
 
 def rgb_distance_map_method(method):
     if method == 'rgb':
-        return lambda arr: arr.astype(float)
+        return lambda arr: arr.astype(np.float32)
     if method == 'weighted':
-        scale = np.array([2**0.5, 2.0, 3**0.5], dtype=float)
-        return lambda arr: arr.astype(float) * scale[None, None, :]
+        scale = np.array([2**0.5, 2.0, 3**0.5], dtype=np.float32)
+        return lambda arr: arr.astype(np.float32) * scale
     if method == 'lab':
-        if _have_skimage:
-            def to_lab(arr):
-                f = arr.astype('float32') / 255.0
-                return lab
-            return to_lab
-        elif _have_colormath:
-            def to_lab(arr):
-                h, w, _ = arr.shape
-                flat = arr.reshape(-1, 3)
-                uniq, inv = np.unique(flat, axis=0, return_inverse=True)
-                lab_list = []
-                for (r,g,b) in uniq:
-                    srgb = sRGBColor(r/255.0, g/255.0, b/255.0, is_upscaled=False)
-                    lab = convert_color(srgb, LabColor)
-                    lab_list.append([lab.lab_l, lab.lab_a, lab.lab_b])
-                lab_arr = np.array(lab_list, dtype=float)[inv].reshape(h, w, 3)
-                return lab_arr
-            return to_lab
-        else:
-            print("警告: skimage または colormath が利用できないため、'lab' を計算できません。'weighted'で代替します。", file=sys.stderr)
-            scale = np.array([2**0.5, 2.0, 3**0.5], dtype=float)
-            return lambda arr: arr.astype(float) * scale[None, None, :]
+        return srgb_to_lab
     raise ValueError('unknown method')
 
-def main():
-    print("PlaceBot(convert.py) by @raizouxyz")
-    print("Repository: https://github.com/raizouxyz/placebot\n")
-    
-    args = parse_args()
+def palette_to_space(palette, method):
+    if method == 'lab':
+        return srgb_to_lab(palette.astype(np.uint8))
+    return rgb_distance_map_method(method)(palette)
 
-    palette = load_palette("./palette.txt")
-    print(f'読み込んだパレット: {palette.shape[0]} 色')
+def pack_rgb(arr):
+    flat = arr.reshape(-1, 3)
+    return (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
 
-    img = Image.open(args.input)
-    orig_mode = img.mode
-    has_alpha = ('A' in orig_mode)
-    pixels, alpha = rgb_to_array(img)
-    H, W, _ = pixels.shape
-    print(f'入力画像: {args.input} -> {W}x{H}, モード={orig_mode}')
+def unpack_rgb(keys):
+    out = np.empty((keys.shape[0], 3), dtype=np.uint8)
+    out[:, 0] = keys >> 16
+    out[:, 1] = (keys >> 8) & 0xff
+    out[:, 2] = keys & 0xff
+    return out
+
+def unique_colors(pixels):
+    # RGBを24bit整数にまとめて1次元で重複除去する。画素数が多いときは
+    # 全色分の存在ビットマップと累積和で逆引き表を作る方がソートより速い
+    keys = pack_rgb(pixels)
+    if keys.shape[0] >= 1 << 21:
+        present = np.zeros(1 << 24, dtype=bool)
+        present[keys] = True
+        uniq = np.flatnonzero(present).astype(np.uint32)
+        rank = np.cumsum(present, dtype=np.int32)
+        rank -= 1
+        inv = rank[keys]
+    else:
+        uniq, inv = np.unique(keys, return_inverse=True)
+    return unpack_rgb(uniq), inv
+
+def palette_key(palette, method):
+    h = hashlib.sha1()
+    h.update(method.encode('utf-8'))
+    h.update(palette.astype(np.uint8).tobytes())
+    return h.hexdigest()[:16]
+
+def lut_path(palette, method, cache_dir=LUT_CACHE_DIR):
+    return os.path.join(cache_dir, f'lut_{method}_{palette_key(palette, method)}.npy')
 
-    method = args.method
+def build_lut(palette, method):
+    if palette.shape[0] > 256:
+        raise ValueError('変換表は256色までのパレットにしか対応していません。')
+    match = _int_matcher(palette, method) if method in _INT_WEIGHTS else _brute_matcher(palette, method)
+    lut = np.empty(1 << 24, dtype=np.uint8)
+    for r in range(256):
+        keys = np.arange(r << 16, (r + 1) << 16, dtype=np.uint32)
+        lut[r << 16:(r + 1) << 16] = match(unpack_rgb(keys))
+    return lut
+
+def load_lut(palette, method, cache_dir=LUT_CACHE_DIR):
+    path = lut_path(palette, method, cache_dir)
+    if not os.path.exists(path):
+        print(f'変換表を作成中: {path}')
+        lut = build_lut(palette, method)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, lut)
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
+
+def _argmin_affine(points, coef, chunk=16384):
+    # [p, 1] @ coef を小分けに計算して、行ごとの最小の列を返す
+    M = points.shape[0]
+    idxs = np.empty(M, dtype=np.int64)
+    buf = np.ones((min(chunk, M), coef.shape[0]), dtype=np.float32)
+    for s in range(0, M, chunk):
+        e = min(M, s+chunk)
+        pts = buf[:e - s]
+        with profile_stage('query'):
+            pts[:, :-1] = points[s:e]
+            idxs[s:e] = np.argmin(pts @ coef, axis=1)
+    return idxs
+
+def _expanded_coef(palette_space, weights):
+    # ‖p−c‖²_w = ‖p‖²_w − 2p·(w∘c) + ‖c‖²_w。第1項はどの c が最小かに関係しないので省き、
+    # 残りを [p, 1] と [−2(w∘c), ‖c‖²_w] の行列積1回で求める
+    wc = palette_space * weights
+    return np.vstack([-2.0 * wc.T, np.sum(wc * palette_space, axis=1)]).astype(np.float32)
+
+def _profiled_to_space(method):
     to_space = rgb_distance_map_method(method)
+    def transform(rgb):
+        with profile_stage('color_space'):
+            return profile_array(to_space(rgb))
+    return transform
 
+# 最近傍探索のバックエンド。いずれも (palette, method) を受け取り、
+# uint8 の RGB 配列 (n, 3) からパレット番号を返す関数を作る
+def _brute_matcher(palette, method):
+    to_space = _profiled_to_space(method)
+    palette_space = palette_to_space(palette, method)
     if method == 'lab':
-        if _have_skimage:
-            pal_f = palette.astype('float32') / 255.0
-            pal_lab = rgb2lab(pal_f.reshape(1, -1, 3)).reshape(-1, 3)
-        elif _have_colormath:
-            pal_lab = []
-            for (r,g,b) in palette:
-                srgb = sRGBColor(r/255.0, g/255.0, b/255.0, is_upscaled=False)
-                lab = convert_color(srgb, LabColor)
-                pal_lab.append([lab.lab_l, lab.lab_a, lab.lab_b])
-            pal_lab = np.array(pal_lab, dtype=float)
-        else:
-            pal_lab = (palette.astype(float) * np.array([2**0.5,2.0,3**0.5])[None,:])
-    else:
-        if method == 'rgb':
-            pal_lab = palette.astype(float)
-        else:
-            scale = np.array([2**0.5, 2.0, 3**0.5], dtype=float)
-            pal_lab = palette.astype(float) * scale[None, :]
-
-    palette_space = pal_lab.astype(float)
-
-    if args.reduce_unique:
-        flat = pixels.reshape(-1, 3)
-        uniq_colors, inv = np.unique(flat, axis=0, return_inverse=True)
-        print(f'ユニーク色数: {uniq_colors.shape[0]} (reduce_unique ON)')
-        if method == 'lab' and ( _have_skimage or _have_colormath):
-            uniq_img = uniq_colors.reshape(-1,1,3).astype(np.uint8)
-            uniq_lab = to_space(uniq_img).reshape(-1,3)
-            query_points = uniq_lab
-        else:
-            query_points = (uniq_colors.astype(float) * (np.array([1,1,1]) if method=='rgb' else np.array([2**0.5,2.0,3**0.5]))[None,:])
-    else:
-        if method == 'lab' and (_have_skimage or _have_colormath):
-            img_space = to_space(pixels)
-        else:
-            img_space = to_space(pixels)
-        flat = img_space.reshape(-1,3)
-        query_points = flat
+        return lambda rgb: nearest_ciede2000(to_space(rgb), palette_space)
+    coef = _expanded_coef(palette_space.astype(np.float64), 1.0)
+    return lambda rgb: _argmin_affine(to_space(rgb), coef)
+
+# 各チャンネルの重みの2乗 (weighted は √2, 2, √3 倍した空間での距離と同じ)
+_INT_WEIGHTS = {'rgb': (1, 1, 1), 'weighted': (2, 4, 3)}
 
-    if _have_sklearn:
-        tree = KDTree(palette_space)
-        M = query_points.shape[0]
+
+def _int_matcher(palette, method):
+    # 画素・パレットとも整数のまま重み付き2乗距離を比べる。途中の値はすべて
+    # 2^24 未満の整数なので float32 の行列積でも丸め誤差が出ず、
+    # 整数で差を取って2乗和を求めた場合と同じ番号になる
+    if method not in _INT_WEIGHTS:
+        raise ValueError(f"'{method}' は int バックエンドに対応していません。")
+    weights = np.array(_INT_WEIGHTS[method], dtype=np.int64)
+    coef = _expanded_coef(palette.astype(np.int64), weights)
+    return lambda rgb: _argmin_affine(rgb, coef)
+
+def _kdtree_matcher(palette, method):
+    if method == 'lab':
+        raise ValueError("KD木はCIEDE2000を扱えないため 'lab' には使えません。")
+    from sklearn.neighbors import KDTree
+    to_space = _profiled_to_space(method)
+    tree = KDTree(palette_to_space(palette, method))
+    def match(rgb):
+        M = rgb.shape[0]
+        idxs = np.empty(M, dtype=np.int64)
         batch = 200000
-        idxs = np.empty(M, dtype=int)
         for s in range(0, M, batch):
             e = min(M, s+batch)
-            dist, idc = tree.query(query_points[s:e], k=1)
-            idxs[s:e] = idc[:,0]
-    elif _have_scipy:
-        tree = ScipyKDTree(palette_space)
-        idxs = tree.query(query_points)[1]
+            points = to_space(rgb[s:e])
+            with profile_stage('query'):
+                idxs[s:e] = tree.query(points, k=1, return_distance=False)[:, 0]
+        return idxs
+    return match
+
+def _ckdtree_matcher(palette, method):
+    if method == 'lab':
+        raise ValueError("KD木はCIEDE2000を扱えないため 'lab' には使えません。")
+    from scipy.spatial import cKDTree
+    to_space = _profiled_to_space(method)
+    tree = cKDTree(palette_to_space(palette, method))
+    def match(rgb):
+        points = to_space(rgb)
+        with profile_stage('query'):
+            return tree.query(points)[1]
+    return match
+
+def _lut_matcher(palette, method):
+    lut = load_lut(palette, method)
+    def match(rgb):
+        with profile_stage('query'):
+            return profile_array(lut[pack_rgb(rgb)])
+    return match
+
+NN_BACKENDS = {
+    'brute': _brute_matcher,
+    'int': _int_matcher,
+    'kdtree': _kdtree_matcher,
+    'ckdtree': _ckdtree_matcher,
+    'lut': _lut_matcher,
+}
+
+# 外部ライブラリが必要なバックエンド
+BACKEND_MODULES = {'kdtree': 'sklearn', 'ckdtree': 'scipy'}
+
+
+def _importable(name):
+    return importlib.util.find_spec(name) is not None
+
+def select_backend(palette, method, n_points):
+    # 31色程度のパレットなら総当たりの方がKD木より速い。変換表は一度作れば
+    # 使い回せるので、既にあるか、作る手間より探索する画素の方が十分多いときに使う
+    if palette.shape[0] <= 256 and (n_points >= LUT_AUTO_PIXELS or os.path.exists(lut_path(palette, method))):
+        return 'lut'
+    if method == 'lab':
+        return 'brute'
+    if palette.shape[0] <= 64:
+        return 'int'
+    if _importable('sklearn'):
+        return 'kdtree'
+    if _importable('scipy'):
+        return 'ckdtree'
+    return 'int'
+
+def resolve_backend(ctx, n_points):
+    if ctx['backend'] != 'auto':
+        return ctx['backend']
+    return select_backend(ctx['palette'], ctx['method'], n_points)
+
+def get_matcher(ctx, n_points, backend=None):
+    name = backend or resolve_backend(ctx, n_points)
+    match = ctx['matchers'].get(name)
+    if match is None:
+        with profile_stage('index_build'):
+            match = ctx['matchers'][name] = NN_BACKENDS[name](ctx['palette'], ctx['method'])
+    return match
+
+def error_diffusion_dither(pixels, match, palette, kernel, carry=None):
+    # 画素 (y, x) を波面 t = x + k*y ごとに処理する。k を拡散先がすべて後の波面に
+    # 入るように選べば、同じ波面上の画素は互いに独立なのでまとめて量子化できる。
+    # 値は 1/2^DIFFUSION_SHIFT 単位の整数で持つ。整数の加算は順序によらないので、
+    # 前の帯から下にはみ出した誤差 carry を後から足しても、戻り値の carry を
+    # 次の帯に渡せば帯に分けても一枚で処理した場合と同じ結果になる
+    div, taps = DIFFUSION_KERNELS[kernel]
+    k = max([1] + [-dx // dy + 1 for dy, dx, _ in taps if dy > 0])
+    pad_x = max(abs(dx) for _, dx, _ in taps)
+    pad_y = max(dy for dy, _, _ in taps)
+    H, W, _ = pixels.shape
+    Wp = W + 2 * pad_x
+    buf = np.zeros((H + pad_y, Wp, 3), dtype=np.int32)
+    buf[:H, pad_x:pad_x + W] = pixels.astype(np.int32) << DIFFUSION_SHIFT
+    if carry is not None:
+        buf[:pad_y, pad_x:pad_x + W] += carry
+    next_carry = buf[H:, pad_x:pad_x + W]
+    buf = buf.reshape(-1)
+    palette_s = palette.astype(np.int32) << DIFFUSION_SHIFT
+    weights = [(3 * (dy * Wp + dx), w) for dy, dx, w in taps]
+    shift = div.bit_length() - 1
+    idx = np.empty(H * W, dtype=np.int64)
+    buf_steps = (3 * np.arange(H) * (Wp - k))[:, None] + np.arange(3)
+    out_steps = np.arange(H) * (W - k)
+    for t in range(W + k * (H - 1)):
+        y0 = max(0, -(-(t - W + 1) // k))
+        n = min(H - 1, t // k) - y0 + 1
+        x0 = t - k * y0
+        pos = (buf_steps[:n] + 3 * (y0 * Wp + pad_x + x0)).reshape(-1)
+        val = np.clip(buf.take(pos), 0, 255 << DIFFUSION_SHIFT)
+        i = match(((val + (1 << DIFFUSION_SHIFT - 1)) >> DIFFUSION_SHIFT).astype(np.uint8).reshape(-1, 3))
+        idx[out_steps[:n] + (y0 * W + x0)] = i
+        err = val - palette_s.take(i, axis=0).reshape(-1)
+        for off, w in weights:
+            buf[pos + off] += (err * w) >> shift
+    return idx.reshape(H, W), next_carry.copy()
+
+def bayer_matrix(n):
+    m = np.zeros((1, 1), dtype=np.int64)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return ((m + 0.5) / (n * n) - 0.5).astype(np.float32)
+
+def load_threshold_map(path):
+    tex = np.asarray(Image.open(path).convert('L'), dtype=np.float32)
+    return (tex + 0.5) / 256.0 - 0.5
+
+def ordered_dither(pixels, threshold, strength, y0=0, x0=0):
+    # 閾値は画像内の絶対座標で決まるので、分割して処理しても結果は変わらない
+    H, W, _ = pixels.shape
+    th, tw = threshold.shape
+    offset = np.rint(threshold * strength).astype(np.int16)
+    offset = offset[(y0 + np.arange(H)) % th][:, (x0 + np.arange(W)) % tw]
+    out = pixels.astype(np.int16)
+    out += offset[:, :, None]
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+# パレットと探索バックエンドを保持して、画像を色番号 (0 は透明、i+1 はパレットの i 番目) に変換する。
+# 作ったバックエンドは使い回すので、同じインスタンスを複数のスレッドから使ってよい
+#   q = Quantizer('./data/palette.txt', method='lab')
+#   ids = q.quantize(Image.open('input.png'))
+class Quantizer:
+    def __init__(self, palette=DEFAULT_PALETTE, method='rgb', backend='auto', reduce_unique=False,
+                 dither='none', bayer_size=8, threshold_map=None, dither_strength=32.0,
+                 alpha_threshold=1, background=None, verbose=False):
+        if isinstance(palette, str):
+            palette = load_palette(palette)
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+        if palette.shape[0] > 255:
+            raise ValueError('色番号での出力は255色までのパレットにしか対応していません。')
+        if method not in METHODS:
+            raise ValueError(f'unknown method: {method}')
+        if backend != 'auto' and backend not in NN_BACKENDS:
+            raise ValueError(f'unknown backend: {backend}')
+        if dither not in ('none', 'ordered') and dither not in DIFFUSION_KERNELS:
+            raise ValueError(f'unknown dither: {dither}')
+        threshold = None
+        if dither == 'ordered':
+            if threshold_map is None:
+                threshold = bayer_matrix(bayer_size)
+            elif isinstance(threshold_map, str):
+                threshold = load_threshold_map(threshold_map)
+            else:
+                threshold = np.asarray(threshold_map, dtype=np.float32)
+        # アルファ0の画素は出力でも透明になるので、閾値は1以上に限る
+        if not 1 <= alpha_threshold <= 256:
+            raise ValueError('alpha_threshold は 1〜256 で指定してください。')
+        if isinstance(background, str):
+            background = parse_color(background)
+        elif background is not None:
+            background = np.asarray(background, dtype=np.uint8).reshape(3)
+        self.palette = palette
+        self.ctx = {
+            'palette': palette,
+            'method': method,
+            'backend': backend,
+            'matchers': {},
+            'reduce_unique': reduce_unique,
+            'dither': dither,
+            'threshold': threshold,
+            'strength': dither_strength,
+            'alpha_threshold': alpha_threshold,
+            'background': background,
+            'verbose': verbose,
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, palette, args):
+        return cls(palette, args.method, args.nn_backend, args.reduce_unique, args.dither,
+                   args.bayer_size, args.threshold_map, args.dither_strength,
+                   args.alpha_threshold, args.background, verbose=True)
+
+    def prepare(self, n_points):
+        backend = resolve_backend(self.ctx, n_points)
+        with self._lock:
+            get_matcher(self.ctx, n_points, backend)
+        return backend
+
+    def quantize(self, image):
+        pixels, alpha = apply_alpha(*image_to_arrays(image), self.ctx)
+        H, W, _ = pixels.shape
+        idx, _ = quantize_block(pixels, self.ctx, backend=self.prepare(H * W), alpha=alpha)
+        return to_color_ids(idx, alpha)
+
+    def quantize_frames(self, image):
+        W, H = image.size
+        for idx, alpha, _, _ in iter_frames(image, self.ctx, self.prepare(H * W)):
+            yield to_color_ids(idx, alpha)
+
+    def to_rgb(self, ids):
+        return np.vstack([np.zeros((1, 3), dtype=np.uint8), self.palette])[ids]
+
+def image_to_arrays(image):
+    if isinstance(image, Image.Image):
+        return rgb_to_array(image)
+    arr = np.asarray(image)
+    if arr.dtype != np.uint8:
+        raise ValueError('配列は uint8 で渡してください。')
+    if arr.ndim == 2:
+        return np.repeat(arr[:, :, None], 3, axis=2), None
+    if arr.ndim == 3 and arr.shape[2] == 4:
+        return arr[:, :, :3], arr[:, :, 3]
+    if arr.ndim == 3 and arr.shape[2] == 3:
+        return arr, None
+    raise ValueError(f'画像配列の形が不正です: {arr.shape}')
+
+def apply_alpha(pixels, alpha, ctx):
+    # 閾値未満の画素はアルファを0にして、以降は探索しない。背景色があれば
+    # 残りの半透明の画素を背景色と合成し (sRGB 値での over 合成)、不透明にする
+    if alpha is None:
+        return pixels, None
+    with profile_stage('alpha'):
+        visible = alpha >= ctx['alpha_threshold']
+        background = ctx['background']
+        if background is None:
+            return pixels, np.where(visible, alpha, 0).astype(np.uint8)
+        partial = visible & (alpha < 255)
+        if partial.any():
+            a = alpha[partial].astype(np.uint32)[:, None]
+            pixels = pixels.copy()
+            pixels[partial] = (pixels[partial] * a + background * (255 - a) + 127) // 255
+        return pixels, np.where(visible, 255, 0).astype(np.uint8)
+
+def quantize_block(pixels, ctx, y0=0, carry=None, backend=None, alpha=None):
+    # alpha は apply_alpha の結果で、0 の画素は探索せず番号0のままにする。
+    # 誤差拡散は隣の画素に誤差を流すので、透明な画素も含めて全体を処理する
+    H, W, _ = pixels.shape
+    if ctx['dither'] == 'ordered':
+        with profile_stage('dither'):
+            pixels = profile_array(ordered_dither(pixels, ctx['threshold'], ctx['strength'], y0))
+    if ctx['dither'] in DIFFUSION_KERNELS:
+        match = get_matcher(ctx, H * W, backend)
+        with profile_stage('dither'):
+            return error_diffusion_dither(pixels, match, ctx['palette'], ctx['dither'], carry)
+
+    if alpha is not None:
+        visible = alpha != 0
+        n_visible = int(np.count_nonzero(visible))
+        if n_visible < H * W:
+            idx = np.zeros((H, W), dtype=np.intp)
+            if n_visible:
+                idx[visible] = match_pixels(pixels[visible], ctx, backend)
+            return idx, None
+    return match_pixels(pixels.reshape(-1, 3), ctx, backend).reshape(H, W), None
+
+def match_pixels(flat, ctx, backend=None):
+    if ctx['reduce_unique'] and (backend or ctx['backend']) != 'lut':
+        with profile_stage('unique_colors'):
+            uniq_colors, inv = unique_colors(flat)
+            profile_array(inv)
+        if ctx['verbose']:
+            print(f'ユニーク色数: {uniq_colors.shape[0]} (reduce_unique ON)')
+        idx = get_matcher(ctx, uniq_colors.shape[0], backend)(uniq_colors)
+        with profile_stage('inverse_mapping'):
+            return profile_array(idx[inv])
+    return get_matcher(ctx, flat.shape[0], backend)(flat)
+
+def iter_frames(img, ctx, backend=None, size=None):
+    # 前のフレームと同じ画素は前の結果をそのまま使い、変わった画素だけ探索する。
+    # 誤差拡散は周りの画素に依存するので毎フレーム全体を変換し直す
+    W, H = size or img.size
+    backend = backend or resolve_backend(ctx, W * H)
+    reuse = ctx['dither'] not in DIFFUSION_KERNELS
+    prev_pixels = prev_idx = prev_visible = None
+    for i in range(getattr(img, 'n_frames', 1)):
+        with profile_stage('decode'):
+            img.seek(i)
+            frame = img.convert('RGBA')
+        with profile_stage('rgb_to_array'):
+            pixels, alpha = rgb_to_array(frame)
+            profile_array(pixels)
+        if size is not None:
+            with profile_stage('resize'):
+                pixels, alpha = area_downscale([(0, pixels, alpha)], frame.size, size)
+        pixels, alpha = apply_alpha(pixels, alpha, ctx)
+        duration = img.info.get('duration', 100)
+        if not reuse:
+            with profile_stage('quantize'):
+                idx, _ = quantize_block(pixels, ctx, backend=backend, alpha=alpha)
+            yield idx, alpha, duration, H * W
+            continue
+        if ctx['dither'] == 'ordered':
+            with profile_stage('dither'):
+                pixels = profile_array(ordered_dither(pixels, ctx['threshold'], ctx['strength']))
+        # 透明な画素は探索しないので、透明から見えるようになった画素も変わった画素に含める
+        visible = alpha != 0
+        with profile_stage('quantize'):
+            if prev_pixels is None:
+                idx = np.zeros((H, W), dtype=np.intp)
+                changed = visible
+            else:
+                idx = prev_idx.copy()
+                changed = (np.any(pixels != prev_pixels, axis=2) | ~prev_visible) & visible
+            n_changed = int(np.count_nonzero(changed))
+            if n_changed:
+                idx[changed] = match_pixels(pixels[changed], ctx, backend)
+        prev_pixels, prev_idx, prev_visible = pixels, idx, visible
+        yield idx, alpha, duration, n_changed
+
+_worker_ctx = None
+_worker_args = None
+
+
+def _init_worker(palette, args):
+    global _worker_ctx, _worker_args, _profiler
+    # fork で起動したワーカーには親のプロファイラが引き継がれるので止める
+    _profiler = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _worker_ctx = Quantizer.from_args(palette, args).ctx
+    _worker_args = args
+
+def _attach_shm(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # Python 3.13 未満では開いただけの側も後始末の対象に登録されるので外す
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _quantize_rows(task):
+    in_name, out_name, shape, y0, y1, row_offset, backend = task
+    shm_in = _attach_shm(in_name)
+    shm_out = _attach_shm(out_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm_in.buf)
+        out = np.ndarray(shape[:2], dtype=np.uint8, buffer=shm_out.buf)
+        # 4チャンネル目は apply_alpha 済みのアルファ
+        alpha = pixels[y0:y1, :, 3] if shape[2] == 4 else None
+        out[y0:y1], _ = quantize_block(pixels[y0:y1, :, :3], _worker_ctx, row_offset + y0,
+                                       backend=backend, alpha=alpha)
+        del pixels, out, alpha
+    finally:
+        shm_in.close()
+        shm_out.close()
+    return y1 - y0
+
+def create_pool(palette, args):
+    return multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(palette, args))
+
+def quantize_parallel(pool, pixels, ctx, workers, row_offset=0, backend=None, alpha=None):
+    # 画素と結果は共有メモリに置き、ワーカーには行範囲だけを渡す。
+    # バックエンドは画像全体の大きさで決め、変換表が要るなら先に作っておく
+    if alpha is not None:
+        pixels = np.dstack([pixels, alpha])
+    H, W, _ = pixels.shape
+    backend = backend or resolve_backend(ctx, H * W)
+    get_matcher(ctx, H * W, backend)
+    rows = max(1, min(256, -(-H // (workers * 4))))
+    shm_in = shared_memory.SharedMemory(create=True, size=max(1, pixels.nbytes))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, H * W))
+    try:
+        np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm_in.buf)[:] = pixels
+        tasks = [(shm_in.name, shm_out.name, pixels.shape, y0, min(H, y0 + rows), row_offset, backend)
+                 for y0 in range(0, H, rows)]
+        for _ in pool.imap_unordered(_quantize_rows, tasks):
+            pass
+        return np.ndarray((H, W), dtype=np.uint8, buffer=shm_out.buf).copy()
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
+
+# 無圧縮で1タイルに収まっている画像の (チャンネル数, RGBの並び, アルファの位置)
+_RAW_LAYOUTS = {
+    'RGB': (3, [0, 1, 2], None),
+    'RGBX': (4, [0, 1, 2], None),
+    'RGBA': (4, [0, 1, 2], 3),
+    'BGR': (3, [2, 1, 0], None),
+    'BGRX': (4, [2, 1, 0], None),
+    'BGRA': (4, [2, 1, 0], 3),
+}
+
+
+def open_raw_rows(img):
+    # PPM / BMP / 無圧縮TIFF などはファイルをメモリマップして、必要な行だけ読む
+    tile = getattr(img, 'tile', None)
+    path = getattr(img, 'filename', None)
+    if not tile or len(tile) != 1 or not path:
+        return None
+    codec, extents, offset, args = tuple(tile[0])[:4]
+    if codec != 'raw' or tuple(extents) != (0, 0) + img.size:
+        return None
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+    if rawmode not in _RAW_LAYOUTS or img.mode not in ('RGB', 'RGBA'):
+        return None
+    channels, order, alpha_ch = _RAW_LAYOUTS[rawmode]
+    if alpha_ch is None and img.mode == 'RGBA':
+        return None
+    W, H = img.size
+    stride = stride or W * channels
+    rows = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(H, stride))
+    return rows, channels, order, alpha_ch if img.mode == 'RGBA' else None, orientation < 0
+
+def iter_strips(img, strip_height):
+    W, H = img.size
+    raw = open_raw_rows(img)
+    for y0 in range(0, H, strip_height):
+        y1 = min(H, y0 + strip_height)
+        if raw is None:
+            with profile_stage('decode'):
+                strip = img.crop((0, y0, W, y1))
+            with profile_stage('rgb_to_array'):
+                pixels, alpha = rgb_to_array(strip)
+                profile_array(pixels)
+            yield y0, pixels, alpha
+            continue
+        rows, channels, order, alpha_ch, bottom_up = raw
+        with profile_stage('decode'):
+            block = rows[H - y1:H - y0][::-1] if bottom_up else rows[y0:y1]
+            block = np.asarray(block[:, :W * channels]).reshape(y1 - y0, W, channels)
+        with profile_stage('rgb_to_array'):
+            alpha = block[:, :, alpha_ch].copy() if alpha_ch is not None else None
+            pixels = profile_array(block[:, :, order])
+        yield y0, pixels, alpha
+
+def target_size(size, width=None, height=None, scale=None):
+    # 縮小だけを行い、元より大きな幅・高さは元の大きさに揃える
+    W, H = size
+    width = width and min(width, W)
+    height = height and min(height, H)
+    if scale is not None:
+        size = max(1, round(W * scale)), max(1, round(H * scale))
+    elif width and height:
+        size = width, height
+    elif width:
+        size = width, max(1, round(H * width / W))
+    elif height:
+        size = max(1, round(W * height / H)), height
+    return size if size != (W, H) else None
+
+def _linear_to_srgb(lin):
+    lin = np.clip(lin, 0.0, 1.0)
+    srgb = np.where(lin <= 0.0031308, lin * 12.92, 1.055 * np.power(lin, 1 / 2.4) - 0.055)
+    return np.rint(srgb * 255.0).astype(np.uint8)
+
+def _box_edges(n_src, n_dst):
+    edges = np.arange(n_dst + 1) * (n_src / n_dst)
+    edges[-1] = n_src
+    return edges
+
+def area_downscale(strips, src_size, size):
+    # 出力の各画素に対応する元画像の矩形 (端は画素の途中でもよい) の平均を、線形光で求める。
+    # 横方向は帯ごとの累積和を、縦方向は帯をまたいで続く累積和を矩形の端で補間して
+    # 差を取る。アルファがあれば事前乗算してから平均し、色が透明な画素に引きずられないようにする。
+    # float に変換するのは RESIZE_BAND_PIXELS 程度の帯だけで、元画像全体を float にはしない
+    W, H = src_size
+    tw, th = size
+    xe = _box_edges(W, tw)
+    ye = _box_edges(H, th)
+    xi = np.minimum(np.floor(xe).astype(np.intp), W - 1)
+    xf = (xe - xi)[None, :, None]
+    edge_sums = None
+    total = None
+    k = 0
+    rows = max(1, RESIZE_BAND_PIXELS // W)
+    for y0, pixels, alpha in strips:
+        for b in range(0, pixels.shape[0], rows):
+            band = _SRGB_TO_LINEAR[pixels[b:b + rows]]
+            if alpha is not None:
+                a = alpha[b:b + rows, :, None] * np.float32(1 / 255)
+                band = np.concatenate([band * a, a], axis=2)
+            h, _, C = band.shape
+            cum = np.zeros((h, W + 1, C), dtype=np.float64)
+            np.cumsum(band, axis=1, out=cum[:, 1:])
+            cols = np.diff(cum[:, xi] + xf * band[:, xi], axis=1)
+            if edge_sums is None:
+                edge_sums = np.zeros((th + 1, tw, C), dtype=np.float64)
+                total = np.zeros((tw, C), dtype=np.float64)
+            cum_rows = np.empty((h + 1, tw, C), dtype=np.float64)
+            cum_rows[0] = total
+            np.cumsum(cols, axis=0, out=cum_rows[1:])
+            cum_rows[1:] += total
+            top = y0 + b
+            while k <= th and ye[k] <= top + h:
+                yi = min(int(ye[k]) - top, h - 1)
+                edge_sums[k] = cum_rows[yi] + (ye[k] - top - yi) * cols[yi]
+                k += 1
+            total = cum_rows[h]
+    pixels = np.empty((th, tw, 3), dtype=np.uint8)
+    alpha = np.empty((th, tw), dtype=np.uint8) if edge_sums.shape[2] == 4 else None
+    xw = np.diff(xe)[None, :, None]
+    rows = max(1, RESIZE_BAND_PIXELS // tw)
+    for j in range(0, th, rows):
+        area = np.diff(ye[j:j + rows + 1])[:, None, None] * xw
+        out = (np.diff(edge_sums[j:j + rows + 1], axis=0) / area).astype(np.float32)
+        if alpha is None:
+            pixels[j:j + rows] = _linear_to_srgb(out)
+            continue
+        a = out[:, :, 3:]
+        rgb = np.divide(out[:, :, :3], a, out=np.zeros_like(out[:, :, :3]), where=a > 0)
+        pixels[j:j + rows] = _linear_to_srgb(rgb)
+        alpha[j:j + rows] = np.rint(np.clip(a[:, :, 0], 0.0, 1.0) * 255.0)
+    return pixels, alpha
+
+def downscale(img, size):
+    # JPEG はデコード時に 1/2, 1/4, 1/8 へ縮小できるので (draft)、目標より小さくならない
+    # 範囲で縮小して読み込み、残りを面積平均で縮小する
+    with profile_stage('resize'):
+        img.draft(img.mode, size)
+        W, H = img.size
+        return area_downscale(iter_strips(img, max(1, RESIZE_BAND_PIXELS // W)), (W, H), size)
+
+def to_color_ids(idx, alpha=None):
+    ids = idx.astype(np.uint8)
+    ids += 1
+    if alpha is not None:
+        ids[alpha == 0] = TRANSPARENT_INDEX
+    return ids
+
+def indexed_palette(palette):
+    return [0, 0, 0] + palette.reshape(-1).tolist()
+
+class PngStripWriter:
+    COLOR_TYPES = {'RGB': (2, 3), 'RGBA': (6, 4), 'P': (3, 1)}
+
+    def __init__(self, path, width, height, mode, palette=None):
+        self.color_type, self.channels = self.COLOR_TYPES[mode]
+        self.width = width
+        self.f = open(path, 'wb')
+        self.z = zlib.compressobj(6)
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, self.color_type, 0, 0, 0))
+        if mode == 'P':
+            self._chunk(b'PLTE', bytes(indexed_palette(palette)))
+            self._chunk(b'tRNS', bytes([0]))
+
+    def _chunk(self, tag, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def write_rows(self, arr):
+        h = arr.shape[0]
+        rows = np.zeros((h, 1 + self.width * self.channels), dtype=np.uint8)
+        rows[:, 1:] = arr.reshape(h, -1)
+        data = self.z.compress(rows.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.z.flush())
+        self._chunk(b'IEND', b'')
+        self.f.close()
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp', '.tif', '.tiff', '.ppm', '.tga')
+
+
+def output_path(input_path, ext=None, suffix='_converted'):
+    root, orig_ext = os.path.splitext(input_path)
+    return root + suffix + (ext or orig_ext)
+
+def outputs_for(input_path, args, animated=False):
+    # PNG 以外から拡張子を決めて出力するときは元の拡張子を名前に残し、x.png と x.jpg の
+    # 出力がぶつからないようにする。色番号の .png と .npy は同じ名前にそろえるため、
+    # 元の拡張子だけで決める
+    src_ext = os.path.splitext(input_path)[1].lower()
+    outputs = {}
+    for fmt in args.format:
+        suffix, ext = OUTPUT_SUFFIXES[fmt]
+        if fmt == 'rgb' and args.strip_height > 0 and not animated:
+            ext = '.png'
+        if ext and src_ext and src_ext != '.png':
+            suffix = f'_{src_ext[1:]}{suffix}'
+        outputs[fmt] = output_path(input_path, ext, suffix)
+    return outputs
+
+def find_output_collisions(inputs, args):
+    owners = {}
+    collisions = []
+    for input_path in inputs:
+        for path in outputs_for(input_path, args).values():
+            key = os.path.normcase(os.path.abspath(path))
+            if key in owners:
+                collisions.append((path, owners[key], input_path))
+            else:
+                owners[key] = input_path
+    return collisions
+
+def collect_inputs(pattern):
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+    elif os.path.isfile(pattern):
+        return [pattern]
+    elif any(c in pattern for c in '*?['):
+        paths = sorted(glob.glob(pattern))
     else:
-        M = query_points.shape[0]
-        N = palette_space.shape[0]
-        idxs = np.empty(M, dtype=int)
-        chunk = 100000
-        for s in range(0, M, chunk):
-            e = min(M, s+chunk)
-            pts = query_points[s:e][:,None,:]
-            dif = pts - palette_space[None,:,:]
-            d2 = np.sum(dif*dif, axis=2)
-            idxs[s:e] = np.argmin(d2, axis=1)
-
-    if args.reduce_unique:
-        mapped_palette_indices = idxs
-        flat_pixels = pixels.reshape(-1,3)
-        mapped_idx_for_flat = mapped_palette_indices[inv]
+        return [pattern]
+    suffixes = tuple(suffix for suffix, _ in OUTPUT_SUFFIXES.values())
+    return [p for p in paths
+            if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS)
+            and not os.path.splitext(p)[0].endswith(suffixes)]
+
+def is_up_to_date(input_path, outputs, key):
+    # 出力が入力より新しく、前回の変換と結果の変わる設定 (パレットの内容を含む) が同じなら最新とみなす
+    mtime = os.path.getmtime(input_path)
+    if not all(os.path.exists(p) and os.path.getmtime(p) >= mtime for p in outputs.values()):
+        return False
+    try:
+        with open(settings_path(input_path), encoding='utf-8') as f:
+            return f.read().strip() == key
+    except OSError:
+        return False
+
+def settings_key(ctx, args):
+    h = hashlib.sha1(incremental_key(ctx, args.nn_backend).encode('utf-8'))
+    h.update(f'{args.width}|{args.height}|{args.scale}'.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def settings_path(input_path, cache_dir=LUT_CACHE_DIR):
+    return os.path.join(cache_dir, f'outputs_{input_cache_name(input_path)}.txt')
+
+def save_settings_key(input_path, key):
+    path = settings_path(input_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(key)
+
+def incremental_key(ctx, backend):
+    # 同じ画素でも結果が変わる設定をまとめたもの。画素に反映される閾値や背景色も念のため含める
+    h = hashlib.sha1()
+    h.update(palette_key(ctx['palette'], ctx['method']).encode('utf-8'))
+    h.update(f"{backend}|{ctx['dither']}|{ctx['strength']}|{ctx['alpha_threshold']}".encode('utf-8'))
+    for arr in (ctx['threshold'], ctx['background']):
+        if arr is not None:
+            h.update(arr.tobytes())
+    return h.hexdigest()[:16]
+
+def incremental_enabled(args):
+    # 差分変換は静止画を一度に読み込んで変換するときだけ行う (縮小するときは帯ごとに書き出さない)
+    resize = args.width or args.height or args.scale
+    return args.incremental and args.dither not in DIFFUSION_KERNELS and (args.strip_height <= 0 or resize)
+
+def input_cache_name(input_path):
+    return hashlib.sha1(os.path.abspath(input_path).encode('utf-8')).hexdigest()[:16]
+
+def tile_cache_prefix(input_path, cache_dir=LUT_CACHE_DIR):
+    return os.path.join(cache_dir, f'tiles_{input_cache_name(input_path)}_')
+
+def tile_cache_path(input_path, key, cache_dir=LUT_CACHE_DIR):
+    return f'{tile_cache_prefix(input_path, cache_dir)}{key}.npz'
+
+def tile_hashes(pixels, alpha, tile_size):
+    # 位置と大きさも含めてハッシュを取るので、同じハッシュなら同じ場所の同じタイル
+    H, W, _ = pixels.shape
+    gh, gw = -(-H // tile_size), -(-W // tile_size)
+    hashes = np.empty((gh, gw, 16), dtype=np.uint8)
+    for ty in range(gh):
+        for tx in range(gw):
+            y, x = ty * tile_size, tx * tile_size
+            h = hashlib.sha256()
+            h.update(struct.pack('<4I', y, x, min(tile_size, H - y), min(tile_size, W - x)))
+            h.update(pixels[y:y + tile_size, x:x + tile_size].tobytes())
+            if alpha is not None:
+                h.update(alpha[y:y + tile_size, x:x + tile_size].tobytes())
+            hashes[ty, tx] = np.frombuffer(h.digest()[:16], dtype=np.uint8)
+    return hashes
+
+def load_tile_cache(path, tile_size):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as data:
+            if int(data['tile_size']) != tile_size:
+                return {}
+            hashes, idx = data['hashes'], data['idx']
+    except (OSError, ValueError, KeyError):
+        return {}
+    tiles = {}
+    for ty in range(hashes.shape[0]):
+        for tx in range(hashes.shape[1]):
+            y, x = ty * tile_size, tx * tile_size
+            tiles[hashes[ty, tx].tobytes()] = idx[y:y + tile_size, x:x + tile_size]
+    return tiles
+
+def save_tile_cache(path, tile_size, hashes, idx, prefix):
+    # 同じ入力について設定の違う古いキャッシュは使われなくなるので消し、入力ごとに1つだけ残す
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, tile_size=tile_size, hashes=hashes, idx=idx)
+    os.replace(tmp, path)
+    for old in glob.glob(glob.escape(prefix) + '*.npz'):
+        if old != path:
+            os.remove(old)
+
+def quantize_incremental(pixels, alpha, ctx, input_path, tile_size, backend=None):
+    # 前回と同じタイルはキャッシュの番号をそのまま使い、変わったタイルの見えている画素だけを
+    # まとめて1回で探索する。組織的ディザの閾値は絶対座標で決まるのでタイルごとにかけてよい
+    H, W, _ = pixels.shape
+    backend = backend or resolve_backend(ctx, H * W)
+    path = tile_cache_path(input_path, incremental_key(ctx, backend))
+    with profile_stage('tile_hash'):
+        hashes = tile_hashes(pixels, alpha, tile_size)
+    cached = load_tile_cache(path, tile_size)
+
+    idx = np.zeros((H, W), dtype=np.uint8)
+    changed = []
+    parts = []
+    for ty in range(hashes.shape[0]):
+        for tx in range(hashes.shape[1]):
+            y, x = ty * tile_size, tx * tile_size
+            prev = cached.get(hashes[ty, tx].tobytes())
+            if prev is not None:
+                idx[y:y + tile_size, x:x + tile_size] = prev
+                continue
+            block = pixels[y:y + tile_size, x:x + tile_size]
+            if ctx['dither'] == 'ordered':
+                block = ordered_dither(block, ctx['threshold'], ctx['strength'], y, x)
+            visible = np.ones(block.shape[:2], dtype=bool) if alpha is None else alpha[y:y + tile_size, x:x + tile_size] != 0
+            changed.append((y, x, visible))
+            parts.append(block[visible])
+    if ctx['verbose']:
+        print(f'差分変換: {len(changed)}/{hashes.shape[0] * hashes.shape[1]} タイルを変換し直します')
+
+    if parts:
+        found = match_pixels(np.concatenate(parts), ctx, backend)
+        start = 0
+        for (y, x, visible), part in zip(changed, parts):
+            tile_idx = idx[y:y + tile_size, x:x + tile_size]
+            tile_idx[visible] = found[start:start + part.shape[0]]
+            start += part.shape[0]
+    save_tile_cache(path, tile_size, hashes, idx, tile_cache_prefix(input_path))
+    return idx
+
+def convert_streaming(img, ctx, outputs, strip_height, pool=None, workers=1):
+    W, H = img.size
+    palette = ctx['palette']
+    writers = {}
+    npy = None
+    backend = resolve_backend(ctx, W * H)
+    carry = None
+    try:
+        if 'rgb' in outputs:
+            writers['rgb'] = PngStripWriter(outputs['rgb'], W, H, 'RGBA' if img.mode == 'RGBA' else 'RGB')
+        if 'indexed' in outputs:
+            writers['indexed'] = PngStripWriter(outputs['indexed'], W, H, 'P', palette)
+        if 'npy' in outputs:
+            npy = np.lib.format.open_memmap(outputs['npy'], mode='w+', dtype=np.uint8, shape=(H, W))
+        for y0, pixels, alpha in iter_strips(img, strip_height):
+            pixels, alpha = apply_alpha(pixels, alpha, ctx)
+            with profile_stage('quantize'):
+                if pool is not None:
+                    idx = quantize_parallel(pool, pixels, ctx, workers, y0, backend, alpha)
+                else:
+                    idx, carry = quantize_block(pixels, ctx, y0, carry, backend, alpha)
+            if 'rgb' in writers:
+                with profile_stage('output_assembly'):
+                    out = palette[idx]
+                    if alpha is not None:
+                        out = np.dstack([out, alpha])
+                    profile_array(out)
+                with profile_stage('encode'):
+                    writers['rgb'].write_rows(out)
+            if 'indexed' in writers or npy is not None:
+                with profile_stage('output_assembly'):
+                    ids = to_color_ids(idx, alpha)
+                with profile_stage('encode'):
+                    if 'indexed' in writers:
+                        writers['indexed'].write_rows(ids)
+                    if npy is not None:
+                        npy[y0:y0 + ids.shape[0]] = ids
+    finally:
+        with profile_stage('encode'):
+            for writer in writers.values():
+                writer.close()
+            if npy is not None:
+                npy.flush()
+                del npy
+
+def save_outputs(idx, alpha, palette, outputs):
+    if 'rgb' in outputs:
+        with profile_stage('output_assembly'):
+            out_img_arr = profile_array(palette[idx])
+            if alpha is not None:
+                out_rgba = profile_array(np.dstack([out_img_arr, alpha]))
+                out_pil = Image.fromarray(out_rgba, 'RGBA')
+            else:
+                out_pil = Image.fromarray(out_img_arr, 'RGB')
+        with profile_stage('encode'):
+            out_pil.save(outputs['rgb'])
+    if 'indexed' in outputs or 'npy' in outputs:
+        with profile_stage('output_assembly'):
+            ids = profile_array(to_color_ids(idx, alpha))
+        if 'indexed' in outputs:
+            with profile_stage('output_assembly'):
+                out_pil = Image.fromarray(ids, 'P')
+                out_pil.putpalette(indexed_palette(palette))
+            with profile_stage('encode'):
+                out_pil.save(outputs['indexed'], transparency=TRANSPARENT_INDEX)
+        if 'npy' in outputs:
+            with profile_stage('encode'):
+                np.save(outputs['npy'], ids)
+
+def convert_animation(img, ctx, outputs, size=None):
+    W, H = size or img.size
+    palette = ctx['palette']
+    frames = []
+    durations = []
+    n_changed = 0
+    for idx, alpha, duration, changed in iter_frames(img, ctx, size=size):
+        with profile_stage('output_assembly'):
+            frames.append(to_color_ids(idx, alpha))
+        durations.append(duration)
+        n_changed += changed
+    if ctx['verbose']:
+        print(f'フレーム数: {len(frames)}, 再探索した画素: {n_changed / (len(frames) * W * H):.1%}')
+
+    images = []
+    with profile_stage('output_assembly'):
+        for ids in frames:
+            im = Image.fromarray(ids, 'P')
+            im.putpalette(indexed_palette(palette))
+            im.info['transparency'] = TRANSPARENT_INDEX
+            images.append(im)
+    loop = img.info.get('loop', 0)
+    for fmt in ('rgb', 'indexed'):
+        if fmt not in outputs:
+            continue
+        path = outputs[fmt]
+        ext = os.path.splitext(path)[1].lower()
+        out = images
+        if ext == '.gif':
+            extra = {'disposal': 2, 'optimize': False, 'transparency': TRANSPARENT_INDEX}
+        elif ext == '.webp':
+            # WebP はパレットの透明色を使わないので、透明な画素をアルファに直してから書き出す。
+            # 差分フレームだと透明な部分が切り落とされてアルファのないファイルになることがあるため、
+            # 透明な画素があるときはすべてキーフレームにする
+            with profile_stage('output_assembly'):
+                out = [im.convert('RGBA') for im in images]
+            extra = {'lossless': True}
+            if any((ids == TRANSPARENT_INDEX).any() for ids in frames):
+                extra.update(kmin=1, kmax=1)
+        else:
+            extra = {'format': 'PNG', 'disposal': 0, 'blend': 0, 'transparency': TRANSPARENT_INDEX}
+        with profile_stage('encode'):
+            out[0].save(path, save_all=True, append_images=out[1:], duration=durations, loop=loop, **extra)
+    if 'npy' in outputs:
+        with profile_stage('encode'):
+            np.save(outputs['npy'], np.stack(frames))
+
+def convert_file(input_path, ctx, args, pool=None):
+    img = Image.open(input_path)
+    outputs = outputs_for(input_path, args)
+    size = target_size(img.size, args.width, args.height, args.scale)
+    if ctx['verbose']:
+        if (args.width or 0) > img.size[0] or (args.height or 0) > img.size[1]:
+            print('元の画像より大きい幅・高さは指定できないため、元の大きさに揃えます (拡大はしません)')
+        if size is not None:
+            print(f'{img.size[0]}x{img.size[1]} を {size[0]}x{size[1]} に縮小して変換します')
+    if getattr(img, 'n_frames', 1) > 1:
+        outputs = outputs_for(input_path, args, animated=True)
+        ignored = [name for name, used in (('--strip-height', args.strip_height > 0),
+                                           ('--incremental', args.incremental)) if used]
+        if ignored and ctx['verbose']:
+            print(f'アニメーションはフレームごとに全体を読み込んで変換するため、{", ".join(ignored)} は使いません。')
+        convert_animation(img, ctx, outputs, size)
+        return list(outputs.values())
+    if size is not None:
+        pixels, alpha = downscale(img, size)
+    elif args.strip_height > 0:
+        convert_streaming(img, ctx, outputs, args.strip_height, pool, args.workers)
+        return list(outputs.values())
     else:
-        mapped_idx_for_flat = idxs
+        with profile_stage('decode'):
+            img.load()
+        with profile_stage('rgb_to_array'):
+            pixels, alpha = rgb_to_array(img)
+            profile_array(pixels)
+    pixels, alpha = apply_alpha(pixels, alpha, ctx)
+    if alpha is not None and ctx['verbose']:
+        print(f'透明として扱う画素: {np.count_nonzero(alpha == 0) / alpha.size:.1%}')
+    with profile_stage('quantize'):
+        if incremental_enabled(args):
+            idx = quantize_incremental(pixels, alpha, ctx, input_path, args.tile_size)
+        elif pool is not None:
+            idx = quantize_parallel(pool, pixels, ctx, args.workers, alpha=alpha)
+        else:
+            idx, _ = quantize_block(pixels, ctx, alpha=alpha)
+        profile_array(idx)
+    save_outputs(idx, alpha, ctx['palette'], outputs)
+    return list(outputs.values())
 
-    out_flat = palette[mapped_idx_for_flat]
-    out_img_arr = out_flat.reshape(H, W, 3).astype(np.uint8)
+def _convert_file_task(input_path):
+    start = time.perf_counter()
+    try:
+        output = convert_file(input_path, _worker_ctx, _worker_args)
+        save_settings_key(input_path, settings_key(_worker_ctx, _worker_args))
+    except Exception as e:
+        return input_path, None, f'{type(e).__name__}: {e}'
+    return input_path, output, time.perf_counter() - start
 
-    if alpha is not None:
-        out_rgba = np.dstack([out_img_arr, alpha])
-        out_pil = Image.fromarray(out_rgba, 'RGBA')
+def convert_batch(inputs, palette, ctx, args):
+    collisions = find_output_collisions(inputs, args)
+    if collisions:
+        for path, first, second in collisions:
+            print(f'出力先が重なっています: {path} ({first} と {second})')
+        sys.exit('出力が上書きされるため一括変換を中止しました。入力ファイルの名前を変えてください。')
+    key = settings_key(ctx, args)
+    todo = [p for p in inputs if args.force or not is_up_to_date(p, outputs_for(p, args), key)]
+    print(f'一括変換: {len(inputs)} 件 (変換 {len(todo)} 件, 最新のためスキップ {len(inputs) - len(todo)} 件)')
+    if not todo:
+        return
+
+    global _worker_ctx, _worker_args
+    if args.workers > 1 and len(todo) > 1:
+        pool = create_pool(palette, args)
+        results = pool.imap_unordered(_convert_file_task, todo)
     else:
-        out_pil = Image.fromarray(out_img_arr, 'RGB')
+        pool = None
+        _worker_ctx, _worker_args = ctx, args
+        results = map(_convert_file_task, todo)
 
-    _output = args.input.split(".")
-    output = _output[0] + "_converted." + _output[1]
+    failed = 0
+    try:
+        for i, (input_path, output, info) in enumerate(results, 1):
+            if output is None:
+                failed += 1
+                print(f'[{i}/{len(todo)}] 失敗: {input_path} ({info})')
+            else:
+                print(f'[{i}/{len(todo)}] {input_path} -> {", ".join(output)} ({info:.2f}秒)')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(f'一括変換完了: 成功 {len(todo) - failed} 件, 失敗 {failed} 件')
+
+def main():
+    print("PlaceBot(convert.py) by @raizouxyz")
+    print("Repository: https://github.com/raizouxyz/placebot\n")
+    
+    args = parse_args()
+    if args.profile or args.profile_json:
+        global _profiler
+        _profiler = StageProfiler()
+        if args.workers > 1:
+            print('--profile はこのプロセスの処理だけを集計します。ワーカー内の内訳を見るには --workers 1 にしてください。')
+
+    try:
+        run(args)
+    finally:
+        if _profiler is not None:
+            _profiler.print_table()
+            if args.profile_json:
+                with open(args.profile_json, 'w', encoding='utf-8') as f:
+                    json.dump(_profiler.to_dict(), f, ensure_ascii=False, indent=2)
+                print(f'プロファイルを保存しました: {args.profile_json}')
+
+def run(args):
+    palette = load_palette(args.palette)
+    print(f'読み込んだパレット: {palette.shape[0]} 色')
+
+    ctx = Quantizer.from_args(palette, args).ctx
+    if args.method == 'lab' and args.nn_backend == 'auto' and not os.path.exists(lut_path(palette, 'lab')):
+        print('lab は総当たりで探索するため時間がかかります。一度 --nn-backend lut で変換表を作ると'
+              '(1分程度)、以降は rgb と同程度の速さで変換できます。')
+    if args.incremental:
+        if args.dither in DIFFUSION_KERNELS:
+            print('誤差拡散ディザは画素ごとの結果が画像全体に依存するため、差分変換せずに全体を変換します。')
+        elif args.strip_height > 0 and not (args.width or args.height or args.scale):
+            print('--strip-height を指定したときは差分変換を行いません。')
+
+    inputs = collect_inputs(args.input)
+    if inputs != [args.input]:
+        convert_batch(inputs, palette, ctx, args)
+        return
+
+    img = Image.open(args.input)
+    W, H = img.size
+    print(f'入力画像: {args.input} -> {W}x{H}, モード={img.mode}')
+
+    pool = None
+    if args.workers > 1:
+        if getattr(img, 'n_frames', 1) > 1:
+            print('アニメーションは前のフレームの結果を使いながら1プロセスで変換するため、--workers は使いません。')
+        elif args.dither in DIFFUSION_KERNELS:
+            print('誤差拡散ディザは並列化できないため、1プロセスで変換します。')
+        elif incremental_enabled(args):
+            print('差分変換では変わったタイルだけを1プロセスでまとめて変換するため、--workers は使いません。')
+        else:
+            pool = create_pool(palette, args)
 
-    out_pil.save(output)
-    print(f'変換完了: {output}')
+    try:
+        output = convert_file(args.input, ctx, args, pool)
+        save_settings_key(args.input, settings_key(ctx, args))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(f'変換完了: {", ".join(output)}')
 
 if __name__ == '__main__':
     main()
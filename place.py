@@ -2,6 +2,7 @@ import json
 import random
 import time
 import tls_client
+import numpy as np
 from PIL import Image
 from capmonster_python import CapmonsterClient, TurnstileTask
 
@@ -33,8 +34,35 @@ with open("./data/tokens.txt", "r") as f:
 
 palette = {"#000000": 1,"#3c3c3c": 2,"#787878": 3,"#d2d2d2": 4,"#ffffff": 5,"#600018": 6,"#ed1c24": 7,"#ff7f27": 8,"#f6aa09": 9,"#f9dd3b": 10,"#fffabc": 11,"#0eb968": 12,"#13e67b": 13,"#87ff5e": 14,"#0c816e": 15,"#10aea6": 16,"#13e1be": 17,"#28509e": 18,"#4093e4": 19,"#60f7f2": 20,"#6b50f6": 21,"#99b1fb": 22,"#780c99": 23,"#aa38b9": 24,"#e09ff9": 25,"#cb007a": 26,"#ec1f80": 27,"#f38da9": 28,"#684634": 29,"#95682a": 30,"#f8b277": 31}
 
-img = Image.open(image_path)
-rgb_img = img.convert("RGB")
+def load_color_ids(path):
+    # convert.py の -f npy / indexed の出力はそのまま色番号として使う (0は配置しない)
+    if path.endswith(".npy"):
+        ids = np.load(path)
+    else:
+        img = Image.open(path)
+        if img.mode == "P":
+            pal = img.getpalette()
+            lut = np.zeros(256, dtype=np.uint8)
+            for i in range(len(pal) // 3):
+                color_code = "#" + "".join(f"{c:02x}" for c in pal[i*3:i*3+3])
+                lut[i] = palette.get(color_code, 0)
+            transparency = img.info.get("transparency")
+            if isinstance(transparency, int):
+                lut[transparency] = 0
+            ids = lut[np.array(img)]
+        else:
+            rgb = np.array(img.convert("RGB")).astype(np.uint32)
+            keys = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+            ids = np.zeros(keys.shape, dtype=np.uint8)
+            for color_code, color in palette.items():
+                ids[keys == int(color_code[1:], 16)] = color
+    ids = ids.copy()
+    if skip_color in palette:
+        ids[ids == palette[skip_color]] = 0
+    return ids
+
+color_ids = load_color_ids(image_path)
+height, width = color_ids.shape
 
 session = tls_client.Session(client_identifier="chrome_124",random_tls_extension_order=True)
 client = CapmonsterClient(api_key=config["capmonster_apikey"])
@@ -61,26 +89,23 @@ while True:
             charge_max = response.json()["charges"]["max"]
             request_data = {"colors":[],"coords":[],"t":""}
 
-            for x in range(rgb_img.size[0]):
+            for x in range(width):
                 if x+start_x < skip_x:
                     continue
-                for y in range(rgb_img.size[1]):
+                for y in range(height):
                     if x+start_x == skip_x and y+start_y < skip_y:
                         continue
 
                     if charge >= 1:
-                        pixel = rgb_img.getpixel((x, y))
-                        color_code = "#"+''.join(f"{c:02x}" for c in pixel)
-                        if color_code == skip_color or color_code not in palette:
+                        color = int(color_ids[y, x])
+                        if color == 0:
                             continue
 
-                        color = palette.get(color_code)
-
                         request_data["colors"].append(color)
                         request_data["coords"].append(start_x+x)
                         request_data["coords"].append(start_y+y)
                         charge -= 1
-                    if (x == rgb_img.size[0] - 1 and y == rgb_img.size[1] - 1) or (charge < 1):
+                    if (x == width - 1 and y == height - 1) or (charge < 1):
                         task_id = client.create_task(TurnstileTask(
                             websiteURL="https://wplace.live",
                             websiteKey="0x4AAAAAABpqJe8FO0N84q0F"
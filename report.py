@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from PIL import Image
+import numpy as np
+
+from convert import DEFAULT_PALETTE, load_palette, output_path, pack_rgb
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('--image', '-i', required=True, help='配置したい画像ファイルパス')
+    p.add_argument('--tile', '-t', required=True, nargs='+', help='保存したタイルのPNG (複数指定可)')
+    p.add_argument('--x', type=int, default=0, help='タイル内での画像の開始X座標 (start_x)')
+    p.add_argument('--y', type=int, default=0, help='タイル内での画像の開始Y座標 (start_y)')
+    p.add_argument('--skip-color', default='#000000', help='比較しない色 (keep.py の skip_color)')
+    p.add_argument('--palette', '-p', default=DEFAULT_PALETTE, help='パレットファイルパス')
+    p.add_argument('--block', type=int, default=16, help='荒らされた範囲をまとめるブロックの大きさ')
+    p.add_argument('--overlay', action='store_true', help='差分を重ねた画像を <タイル名>_diff.png に保存する')
+    p.add_argument('--json', help='結果をJSONで保存するパス')
+    return p.parse_args()
+
+
+def load_rgba(path):
+    return np.array(Image.open(path).convert('RGBA'))
+
+
+def diff_tile(ref, tile, start_x, start_y, skip_color):
+    # 画像の各画素について、配置対象か・正しく塗られているかを求める
+    H, W, _ = ref.shape
+    skip = int(skip_color.lstrip('#'), 16)
+    target = (ref[:, :, 3] > 0) & (pack_rgb(ref[:, :, :3]).reshape(H, W) != skip)
+
+    tile_view = np.zeros_like(ref)
+    th, tw, _ = tile.shape
+    y0, x0 = max(0, -start_y), max(0, -start_x)
+    y1, x1 = min(H, th - start_y), min(W, tw - start_x)
+    inside = np.zeros((H, W), dtype=bool)
+    if y0 < y1 and x0 < x1:
+        tile_view[y0:y1, x0:x1] = tile[start_y + y0:start_y + y1, start_x + x0:start_x + x1]
+        inside[y0:y1, x0:x1] = True
+    target &= inside
+
+    painted = tile_view[:, :, 3] > 0
+    same = np.all(tile_view[:, :, :3] == ref[:, :, :3], axis=2)
+    mismatch = target & ~(painted & same)
+    return target, mismatch, int(np.count_nonzero(~inside & (ref[:, :, 3] > 0)))
+
+
+def damaged_regions(mismatch, block):
+    # ブロック単位で荒らされた箇所を8近傍でつなぎ、画素単位の外接矩形を返す
+    H, W = mismatch.shape
+    gh, gw = -(-H // block), -(-W // block)
+    padded = np.zeros((gh * block, gw * block), dtype=bool)
+    padded[:H, :W] = mismatch
+    grid = padded.reshape(gh, block, gw, block).any(axis=(1, 3))
+    seen = np.zeros_like(grid)
+    regions = []
+    for by, bx in zip(*np.nonzero(grid)):
+        if seen[by, bx]:
+            continue
+        comp = np.zeros_like(grid)
+        queue = deque([(by, bx)])
+        seen[by, bx] = True
+        while queue:
+            cy, cx = queue.popleft()
+            comp[cy, cx] = True
+            for ny in range(max(0, cy - 1), min(gh, cy + 2)):
+                for nx in range(max(0, cx - 1), min(gw, cx + 2)):
+                    if grid[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        queue.append((ny, nx))
+        pixels = np.repeat(np.repeat(comp, block, axis=0), block, axis=1)[:H, :W] & mismatch
+        ys = np.flatnonzero(pixels.any(axis=1))
+        xs = np.flatnonzero(pixels.any(axis=0))
+        regions.append({
+            'x': int(xs[0]), 'y': int(ys[0]),
+            'width': int(xs[-1] - xs[0] + 1), 'height': int(ys[-1] - ys[0] + 1),
+            'pixels': int(np.count_nonzero(pixels)),
+        })
+    regions.sort(key=lambda r: r['pixels'], reverse=True)
+    return regions
+
+
+def mismatch_by_color(ref, mismatch, palette):
+    keys = pack_rgb(ref[:, :, :3][mismatch])
+    uniq, counts = np.unique(keys, return_counts=True)
+    ids = {int(k): i + 1 for i, k in enumerate(pack_rgb(palette))}
+    result = []
+    for key, count in zip(uniq.tolist(), counts.tolist()):
+        result.append({'color': f'#{key:06x}', 'id': ids.get(key), 'count': count})
+    result.sort(key=lambda r: r['count'], reverse=True)
+    return result
+
+
+def diff_overlay(ref, target, mismatch):
+    # 正しい画素は薄く、荒らされた画素は赤で表示する
+    out = np.zeros_like(ref)
+    out[:, :, :3] = (ref[:, :, :3].astype(np.uint16) + 510) // 3
+    out[:, :, 3] = np.where(ref[:, :, 3] > 0, 255, 0)
+    out[mismatch] = (255, 0, 0, 255)
+    out[~target & (ref[:, :, 3] > 0), 3] = 96
+    return Image.fromarray(out, 'RGBA')
+
+
+def report_tile(ref, tile_path, args, palette):
+    start = time.perf_counter()
+    tile = load_rgba(tile_path)
+    target, mismatch, outside = diff_tile(ref, tile, args.x, args.y, args.skip_color)
+    n_target = int(np.count_nonzero(target))
+    n_mismatch = int(np.count_nonzero(mismatch))
+    result = {
+        'tile': tile_path,
+        'target': n_target,
+        'mismatch': n_mismatch,
+        'complete': (n_target - n_mismatch) / n_target if n_target else 1.0,
+        'outside': outside,
+        'by_color': mismatch_by_color(ref, mismatch, palette),
+        'regions': damaged_regions(mismatch, args.block),
+    }
+    if args.overlay:
+        result['overlay'] = output_path(tile_path, '.png', '_diff')
+        diff_overlay(ref, target, mismatch).save(result['overlay'])
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def print_report(r):
+    print(f"[{r['tile']}] 完成度 {r['complete']:.2%} ({r['target'] - r['mismatch']}/{r['target']}), "
+          f"不一致 {r['mismatch']} 画素, {r['seconds'] * 1000:.1f}ms")
+    if r['outside']:
+        print(f"  タイルの外にはみ出した画素: {r['outside']}")
+    for c in r['by_color'][:10]:
+        print(f"  色 {c['color']} ({c['id'] if c['id'] is not None else 'パレット外'}): {c['count']}")
+    for g in r['regions'][:10]:
+        print(f"  範囲 x={g['x']} y={g['y']} {g['width']}x{g['height']}: {g['pixels']} 画素")
+    if len(r['regions']) > 10:
+        print(f"  ...ほか {len(r['regions']) - 10} 箇所")
+    if 'overlay' in r:
+        print(f"  差分画像: {r['overlay']}")
+
+
+def main():
+    print("PlaceBot(report.py) by @raizouxyz")
+    print("Repository: https://github.com/raizouxyz/placebot\n")
+
+    args = parse_args()
+    palette = load_palette(args.palette)
+    ref = load_rgba(args.image)
+
+    results = []
+    for tile_path in args.tile:
+        if not os.path.exists(tile_path):
+            print(f'[{tile_path}] ファイルがありません')
+            continue
+        r = report_tile(ref, tile_path, args, palette)
+        print_report(r)
+        results.append(r)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f'JSONを保存しました: {args.json}')
+
+
+if __name__ == '__main__':
+    main()